@@ -1,6 +1,31 @@
 import json
-import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 共用的文件工具函数，请将本脚本与 _fsutil.py 放在同一目录
+from _fsutil import BUF, batch_rename
+
+
+def write_json(path, data):
+    """
+    以 2 空格缩进将数据写入 JSON 文件，安装了 orjson 时使用 orjson 序列化。
+    先写入临时文件再替换，避免中断时损坏原文件。
+    """
+    tmp_path = path + '.tmp'
+    if orjson is not None:
+        with open(tmp_path, 'wb', buffering=BUF) as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=BUF) as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
 
 def convert_and_rename_files(
     input_filename='cave.json',
@@ -27,7 +52,7 @@ def convert_and_rename_files(
     # 加载已有的 userId -> channelId 映射
     user_channel_map = {}
     try:
-        with open(mapping_filename, 'r', encoding='utf-8') as f:
+        with open(mapping_filename, 'r', encoding='utf-8', buffering=BUF) as f:
             user_channel_map = json.load(f)
         print(f"成功从 '{mapping_filename}' 加载了 {len(user_channel_map)} 个已有的用户ID映射。")
     except FileNotFoundError:
@@ -37,7 +62,7 @@ def convert_and_rename_files(
 
     # 读取源数据文件
     try:
-        with open(input_filename, 'r', encoding='utf-8') as f:
+        with open(input_filename, 'r', encoding='utf-8', buffering=BUF) as f:
             data = json.load(f)
     except FileNotFoundError:
         print(f"错误：找不到输入文件 '{input_filename}'。请确保该文件在脚本所在的目录中。")
@@ -46,7 +71,17 @@ def convert_and_rename_files(
         print(f"错误：'{input_filename}' 文件格式不正确，无法解析。")
         return
 
-    output_data = []
+    # 预先分配输出列表，按序号填充，避免逐条追加时反复扩容
+    output_data = [None] * len(data)
+    output_count = 0
+    # 待重命名的文件路径: (旧路径, 新路径)
+    pairs = []
+    # 与 pairs 一一对应的 (element, 原文件名)，原文件仍在但重命名失败时据此回滚
+    renamed_elements = []
+    # 映射是否有新增，没有则无需写回
+    mapping_changed = False
+    # 所有记录共用同一个导入时间，格式与 cave.export 导出的 ISO 8601 UTC 时间一致
+    now_iso = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
     print("\n开始转换和重命名过程...")
 
     for item in data:
@@ -67,6 +102,7 @@ def convert_and_rename_files(
                     print("ChannelId 不能为空，请重新输入。")
                     channel_id = input(f"请输入 userId '{user_id}' (用户名: {user_name}) 对应的 channelId: ")
                 user_channel_map[user_id] = channel_id
+                mapping_changed = True
             except KeyboardInterrupt:
                 print("\n操作被用户中断。正在保存已输入的映射...")
                 break
@@ -74,20 +110,18 @@ def convert_and_rename_files(
         channel_id = user_channel_map[user_id]
 
         # --- 核心逻辑：处理 elements 并重命名文件 ---
-        new_elements = []
+        # 源数据转换后即被丢弃，因此直接在原 element 上修改
+        elements = item.get('elements', [])
         media_index_counter = 1 # 每个 cave_id 的媒体文件索引从1开始
-        for element in item.get('elements', []):
-            new_element = element.copy()
-
+        for element in elements:
             # 如果元素图片是img格式,改为image格式
-            if new_element.get('type') == 'img':
-                new_element['type'] = 'image'
+            if element.get('type') == 'img':
+                element['type'] = 'image'
 
             # [修改] 同时处理 image 和 video 类型
-            if new_element.get('type') in ['image', 'video']:
-                original_filename = new_element.get('file')
+            if element.get('type') in ['image', 'video']:
+                original_filename = element.get('file')
                 if not original_filename:
-                    new_elements.append(new_element)
                     continue
 
                 # 1. 构造新文件名
@@ -98,45 +132,62 @@ def convert_and_rename_files(
                 old_path = os.path.join(resources_dir, os.path.basename(original_filename))
                 new_path = os.path.join(resources_dir, new_filename)
 
-                # 3. 尝试在文件系统中重命名文件
-                try:
-                    if os.path.exists(old_path):
-                        os.rename(old_path, new_path)
-                        print(f"  成功重命名: '{os.path.basename(old_path)}' -> '{new_filename}'")
-                    else:
-                        print(f"  警告: 在 '{resources_dir}' 目录中未找到文件 '{os.path.basename(original_filename)}'。跳过重命名。")
+                # 3. 记录待重命名的文件，稍后统一重命名
+                pairs.append((old_path, new_path))
+                renamed_elements.append((element, original_filename))
 
-                except Exception as e:
-                    print(f"  错误: 重命名 '{os.path.basename(old_path)}' 时发生错误: {e}")
-
-                # 4. 更新 JSON 中的文件名
-                new_element['file'] = new_filename
+                # 4. 预先更新 JSON 中的文件名，重命名失败时再恢复
+                element['file'] = new_filename
                 media_index_counter += 1
 
-            new_elements.append(new_element)
-
-        now = datetime.datetime.now()
-        formatted_time = now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-
         # 构建输出的 JSON 对象
         new_item = {
-            "elements": new_elements,
+            "elements": elements,
             "channelId": channel_id,
             "userId": user_id,
             "userName": user_name,
             "status": "active",
-            "time": formatted_time
+            "time": now_iso
         }
-        output_data.append(new_item)
+        output_data[output_count] = new_item
+        output_count += 1
+
+    # 去除被跳过或因中断而未填充的位置
+    del output_data[output_count:]
+
+    # 批量重命名文件系统中的媒体文件，结果汇总后一次性输出
+    log = []
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        errors = batch_rename(pairs, executor)
+    for (old_path, new_path), (element, original_filename), error in zip(pairs, renamed_elements, errors):
+        if error is None:
+            log.append(f"  成功重命名: '{os.path.basename(old_path)}' -> '{os.path.basename(new_path)}'")
+            continue
+        if isinstance(error, FileNotFoundError):
+            # 原文件不存在 (例如重复运行时已被重命名)，JSON 中仍使用新文件名
+            log.append(f"  警告: 在 '{resources_dir}' 目录中未找到文件 '{os.path.basename(old_path)}'。跳过重命名。")
+            continue
+        # 原文件仍在但未被重命名，JSON 中保留原文件名
+        element['file'] = original_filename
+        if isinstance(error, FileExistsError):
+            log.append(f"  警告: 目标文件 '{os.path.basename(new_path)}' 已存在。跳过重命名。")
+        else:
+            log.append(f"  错误: 重命名 '{os.path.basename(old_path)}' 时发生错误: {error}")
+    if log:
+        print('\n'.join(log))
 
     # 将更新后的映射写回文件
-    with open(mapping_filename, 'w', encoding='utf-8') as f:
-        json.dump(user_channel_map, f, ensure_ascii=False, indent=2)
-    print(f"\n用户ID映射已更新并保存到 '{mapping_filename}'。")
-
-    # 将转换后的数据写入新的 JSON 文件
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, ensure_ascii=False, indent=2)
+    if mapping_changed:
+        write_json(mapping_filename, user_channel_map)
+        print(f"\n用户ID映射已更新并保存到 '{mapping_filename}'。")
+    else:
+        print(f"\n没有新增的用户ID映射，'{mapping_filename}' 保持不变。")
+
+    # 将转换后的数据写入新的 JSON 文件，没有可转换的记录时不写入
+    if not output_data:
+        print("没有可转换的记录，未生成输出文件。")
+        return
+    write_json(output_filename, output_data)
 
     print(f"转换完成！数据已保存到 '{output_filename}'。")
 
@@ -1,17 +1,189 @@
 import os
-import json
+import random
+from functools import partial
+from typing import Iterable
+
 import filetype
 
+# 共用的文件工具函数，请将本脚本与 _fsutil.py 放在同一目录
+from _fsutil import JSON_ERRORS, MediaDir, rewrite_caves, split_ext, stream_batches
+
 # --- 配置区 ---
 # 请根据你的实际情况修改这些路径
 # JSON 文件的路径
 json_path = 'cave_export.json'
 # 包含图片文件的目录路径
 image_dir = 'cave'
+# 是否信任常见的拓展名 (开启后仅抽样检查这些文件，速度更快，但可能漏掉标错的文件)
+trust_common_ext = False
 # --- 配置结束 ---
 
+# 信任模式下无需逐个识别的常见拓展名
+SAFE_EXT = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.mp3', '.wav', '.ogg'}
+# 信任模式下仍会抽样识别的比例，用于发现成批标错的文件
+SAMPLE_RATE = 0.01
+
+# 常见媒体格式的文件头签名: (签名, 拓展名)
+# sniff 只在 filetype (1.2) 对同一文件头必定给出相同结果时返回拓展名，其余情况一律交由 filetype 判断
+SIGS = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF8', 'gif'),
+    (b'ID3', 'mp3'),
+    (b'\xff\xfb', 'mp3'),
+    (b'\xff\xf3', 'mp3'),
+    (b'\xff\xf2', 'mp3'),
+    (b'OggS', 'ogg'),
+)
+# filetype 判定为 MP4 的 ftyp 主品牌；仅兼容品牌中含这些品牌的文件交由 filetype 判断
+MP4_BRANDS = {b'isom', b'mp41', b'mp42'}
+
+
+def _is_apng(head: bytes) -> bool:
+    """
+    与 filetype 相同，按块结构遍历 PNG，在 IDAT 或 IEND 之前出现 acTL 块时为 APNG。
+    """
+    i = 8
+    while len(head) > i:
+        chunk_type = head[i + 4:i + 8]
+        if chunk_type in (b'IDAT', b'IEND'):
+            return False
+        if chunk_type == b'acTL':
+            return True
+        # 跳过块长度、类型、数据和 CRC
+        i += int.from_bytes(head[i:i + 4], 'big') + 12
+    return False
+
+
+def sniff(head: bytes):
+    """
+    按常见媒体格式的文件头签名识别拓展名，无法确定时返回 None，交由 filetype 处理。
+    """
+    if len(head) < 3 or head[128:132] == b'DICM':
+        # filetype 不识别过短的文件头，并优先将偏移 128 处带 DICOM 标记的文件识别为 dcm
+        return None
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png' if not _is_apng(head) else None
+    if head.startswith(b'RIFF'):
+        if head[8:14] == b'WEBPVP':
+            return 'webp'
+        return 'wav' if head[8:12] == b'WAVE' else None
+    if head[4:8] == b'ftyp':
+        # ftyp 盒须完整读入；长度为 256 的盒头 (00 00 01 00) 会先被 filetype 识别为 ico
+        size = int.from_bytes(head[:4], 'big')
+        if 16 <= size <= len(head) and size != 256 and head[8:12] in MP4_BRANDS:
+            return 'mp4'
+        return None
+    return next((ext for sig, ext in SIGS if head.startswith(sig)), None)
+
+
+def probe_file(path: str, dir_fd=None):
+    """
+    读取文件头并识别文件的真实拓展名 (不含 '.')，无法识别时返回 None，读取失败时返回异常对象。
+    优先匹配常见格式的签名，未命中时再使用 filetype。传入 dir_fd 时，path 相对于该目录。
+    """
+    try:
+        # 只需读取文件头，使用无缓冲读取以免多读无用数据
+        with open(path, 'rb', buffering=0,
+                  opener=lambda name, flags: os.open(name, flags, dir_fd=dir_fd)) as fh:
+            head = fh.read(261)
+    except OSError as e:
+        return e
+    ext = sniff(head)
+    if ext is None:
+        kind = filetype.guess(head)
+        ext = kind.extension if kind is not None else None
+    return ext
+
+
+def correct_extensions(data: Iterable, files_base_dir: str, stats: dict, trust_common_ext: bool = False,
+                       max_batch: int = 256, max_workers: int = 32):
+    """
+    识别文件的真实类型并纠正其拓展名，以生成器形式逐条产出处理后的 cave。
+    每累计 max_batch 个文件并发识别、批量重命名一次，统计结果累加到 stats 中。
+    trust_common_ext 为 True 时，拓展名属于 SAFE_EXT 的文件仅按 SAMPLE_RATE 抽样识别。
+    """
+    # 待检查的文件: (element, 原文件名)
+    queued = []
+
+    def collect(cave) -> int:
+        """登记 cave 中需要识别类型的文件，返回登记的数量。"""
+        count = 0
+        # 只处理包含 'file' 键的元素
+        for element in cave.get('elements', []):
+            if 'file' in element:
+                original_filename = element['file']
+                if original_filename not in media.existing:
+                    media.log.append(f"  - [跳过] 文件不存在: {original_filename}")
+                    stats['skipped'] += 1
+                elif (trust_common_ext and random.random() >= SAMPLE_RATE
+                      and split_ext(original_filename)[1].lower() in SAFE_EXT):
+                    # 信任常见拓展名，跳过识别
+                    continue
+                else:
+                    queued.append((element, original_filename))
+                    count += 1
+        return count
+
+    def flush():
+        """并发识别文件类型，再批量重命名物理文件，失败时回滚 JSON 中的记录。"""
+        paths = [media.prefix + original_filename for _, original_filename in queued]
+        kinds = media.map(partial(probe_file, dir_fd=media.dir_fd), paths)
+
+        # 待重命名的文件: (element, 原文件名, 新文件名)
+        pending = []
+        for (element, original_filename), kind in zip(queued, kinds):
+            if isinstance(kind, FileNotFoundError):
+                media.log.append(f"  - [跳过] 文件不存在: {original_filename}")
+                stats['skipped'] += 1
+            elif isinstance(kind, Exception):
+                media.log.append(f"  - [错误] 处理文件 {original_filename} 时发生意外错误: {kind}")
+                stats['skipped'] += 1
+            elif kind is None:
+                # 如果无法识别，则跳过
+                media.log.append(f"  - [跳过] 无法识别文件类型: {original_filename}")
+                stats['skipped'] += 1
+            else:
+                # 获取正确的文件拓展名 (例如: 'jpg', 'png')
+                correct_extension = f".{kind}"
+
+                # 获取当前文件名和拓展名
+                filename_root, current_extension = split_ext(original_filename)
+
+                # 如果当前拓展名不正确，则进行重命名和更新 (已正确的无需操作)
+                if current_extension.lower() != correct_extension.lower():
+                    new_filename = f"{filename_root}{correct_extension}"
+
+                    # 目标文件已存在时拒绝覆盖，保留原记录
+                    if new_filename in media.existing:
+                        media.log.append(f"  - [冲突] 目标文件已存在，跳过: '{original_filename}' -> '{new_filename}'")
+                        stats['skipped'] += 1
+                        continue
 
-def correct_files_and_update_json(json_file_path: str, files_base_dir: str):
+                    # 记录待重命名的文件，并预先在内存中更新 JSON 数据
+                    pending.append((element, original_filename, new_filename))
+                    element['file'] = new_filename
+
+        errors = media.rename([(original_filename, new_filename) for _, original_filename, new_filename in pending])
+        for (element, original_filename, new_filename), error in zip(pending, errors):
+            if error is None:
+                media.log.append(f"  - [成功] '{original_filename}' -> '{new_filename}'")
+                stats['corrected'] += 1
+            elif isinstance(error, FileExistsError):
+                element['file'] = original_filename
+                media.log.append(f"  - [冲突] 目标文件已存在，跳过: '{original_filename}' -> '{new_filename}'")
+                stats['skipped'] += 1
+            else:
+                element['file'] = original_filename
+                media.log.append(f"  - [错误] 重命名文件 {original_filename} 时发生意外错误: {error}")
+                stats['skipped'] += 1
+        queued.clear()
+        media.print_log()
+
+    with MediaDir(files_base_dir, max_workers) as media:
+        yield from stream_batches(data, collect, flush, max_batch)
+
+
+def correct_files_and_update_json(json_file_path: str, files_base_dir: str, trust_common_ext: bool = False):
     """
     读取文件内容以纠正其拓展名，并同步更新 JSON 文件中的记录。
     """
@@ -24,93 +196,36 @@ def correct_files_and_update_json(json_file_path: str, files_base_dir: str):
         print(f"错误: 图片目录未找到，路径: '{files_base_dir}'")
         return
 
-    # 步骤 2: 加载 JSON 数据到内存
+    stats = {'corrected': 0, 'skipped': 0}
+
+    # 步骤 2: 逐条读取 JSON 数据，修正拓展名后写入临时文件，有文件被修正时再替换原文件
     print("正在加载 JSON 数据...")
-    with open(json_file_path, 'r', encoding='utf-8') as f:
-        try:
-            cave_data = json.load(f)
-        except json.JSONDecodeError as e:
-            print(f"错误: JSON 文件格式无效，无法解析。 {e}")
-            return
-
-    total_corrected = 0
-    total_skipped = 0
-    
     print("\n开始检查并修正文件拓展名...")
+    try:
+        saved = rewrite_caves(json_file_path, json_file_path,
+                              partial(correct_extensions, files_base_dir=files_base_dir, stats=stats,
+                                      trust_common_ext=trust_common_ext),
+                              lambda: stats['corrected'] > 0)
+    except JSON_ERRORS as e:
+        print(f"错误: JSON 文件格式无效，无法解析。 {e}")
+        return
+    except OSError as e:
+        print(f"错误: 写入 JSON 文件失败: {e}")
+        if stats['corrected'] > 0:
+            print(f"警告: 已有 {stats['corrected']} 个文件被重命名，但 JSON 文件未更新。")
+        return
 
-    # 步骤 3: 遍历 JSON 中的每一个条目
-    for cave in cave_data:
-        elements = cave.get('elements', [])
-        if not elements:
-            continue
-
-        for element in elements:
-            # 只处理包含 'file' 键的元素
-            if 'file' in element:
-                original_filename = element['file']
-                current_path = os.path.join(files_base_dir, original_filename)
-
-                # 检查文件是否存在
-                if not os.path.exists(current_path):
-                    print(f"  - [跳过] 文件不存在: {original_filename}")
-                    total_skipped += 1
-                    continue
-
-                try:
-                    # 步骤 4: 识别文件的真实类型
-                    kind = filetype.guess(current_path)
-
-                    # 如果无法识别，则跳过
-                    if kind is None:
-                        print(f"  - [跳过] 无法识别文件类型: {original_filename}")
-                        total_skipped += 1
-                        continue
-                    
-                    # 获取正确的文件拓展名 (例如: 'jpg', 'png')
-                    correct_extension = f".{kind.extension}"
-                    
-                    # 获取当前文件名和拓展名
-                    filename_root, current_extension = os.path.splitext(original_filename)
-
-                    # 步骤 5: 如果当前拓展名不正确，则进行重命名和更新
-                    if current_extension.lower() != correct_extension.lower():
-                        new_filename = f"{filename_root}{correct_extension}"
-                        new_path = os.path.join(files_base_dir, new_filename)
-
-                        # 重命名物理文件
-                        os.rename(current_path, new_path)
-
-                        # 在内存中更新 JSON 数据
-                        element['file'] = new_filename
-                        
-                        print(f"  - [成功] '{original_filename}' -> '{new_filename}'")
-                        total_corrected += 1
-                    else:
-                        # 如果拓展名已经是正确的，则无需操作
-                        print(f"  - [正确] 文件拓展名已是正确的: {original_filename}")
-
-                except Exception as e:
-                    print(f"  - [错误] 处理文件 {original_filename} 时发生意外错误: {e}")
-                    total_skipped += 1
-
-    # 步骤 6: 将修改后的数据写回 JSON 文件
-    if total_corrected > 0:
-        print("\n正在将更新后的数据写回 JSON 文件...")
-        try:
-            with open(json_file_path, 'w', encoding='utf-8') as f:
-                # 使用 indent=2 格式化 JSON，使其更易读
-                json.dump(cave_data, f, ensure_ascii=False, indent=2)
-            print("JSON 文件更新成功！")
-        except Exception as e:
-            print(f"错误: 写入 JSON 文件失败: {e}")
+    # 步骤 3: 报告 JSON 文件是否已更新
+    if saved:
+        print("\nJSON 文件更新成功！")
     else:
         print("\n所有文件拓展名均正确，无需更新 JSON 文件。")
 
 
     print("\n--- 操作完成 ---")
-    print(f"已修正的文件数: {total_corrected}")
-    print(f"已跳过的文件数: {total_skipped}")
+    print(f"已修正的文件数: {stats['corrected']}")
+    print(f"已跳过的文件数: {stats['skipped']}")
 
 
 if __name__ == "__main__":
-    correct_files_and_update_json(json_path, image_dir)
\ No newline at end of file
+    correct_files_and_update_json(json_path, image_dir, trust_common_ext)
\ No newline at end of file
@@ -1,6 +1,10 @@
 import os
-import json
 from datetime import datetime, timezone
+from functools import lru_cache, partial
+from typing import Iterable
+
+# 共用的文件工具函数，请将本脚本与 _fsutil.py 放在同一目录
+from _fsutil import JSON_ERRORS, MediaDir, rewrite_caves, split_ext, stream_batches
 
 # --- 配置 ---
 # 请根据你的实际情况修改这些路径
@@ -13,16 +17,15 @@ media_dir = 'cave'
 # --- 配置结束 ---
 
 
+@lru_cache(maxsize=4096)
 def convert_iso_to_ms_timestamp(iso_string: str) -> int:
     """
     将 ISO 8601 时间戳字符串 (以 'Z' 结尾表示UTC)
     转换为毫秒级的 Unix 时间戳。
+    批量导入的 cave 常共用同一时间，因此缓存转换结果。
     """
     # 为了兼容旧版 Python，将 'Z' 替换为 '+00:00'
-    if iso_string.endswith('Z'):
-        iso_string = iso_string[:-1] + '+00:00'
-
-    dt_object = datetime.fromisoformat(iso_string)
+    dt_object = datetime.fromisoformat(iso_string.replace('Z', '+00:00'))
 
     # 确保 datetime 对象是时区感知的 (如果不是则设为UTC)
     if dt_object.tzinfo is None:
@@ -32,21 +35,27 @@ def convert_iso_to_ms_timestamp(iso_string: str) -> int:
     return int(dt_object.timestamp() * 1000)
 
 
-def rename_files_and_update_json(data: list, base_dir: str):
+def rename_files_and_update_json(data: Iterable, base_dir: str, stats: dict = None, max_batch: int = 256):
     """
     重命名文件并同步更新 JSON 数据中的文件名条目。
+    以生成器形式逐条产出处理后的 cave，每累计 max_batch 个文件批量重命名一次。
+    传入 stats 时，处理完成后将统计结果写入其中。
     """
     if not os.path.isdir(base_dir):
         print(f"错误: 找不到媒体文件目录 '{base_dir}'")
-        return None
+        return
 
     print(f"开始处理目录: '{base_dir}'")
     total_renamed = 0
     total_skipped = 0
     updated_json_entries = 0
+    # 待重命名的文件: (cave, element, 原文件名, 新文件名)
+    pending = []
 
-    # 遍历 JSON 数据中的每一条 cave
-    for cave in data:
+    def collect(cave) -> int:
+        """为 cave 中的媒体文件构建新文件名并登记待重命名的文件，返回登记的数量。"""
+        nonlocal total_skipped
+        count = 0
         try:
             # 从 cave 对象中提取元数据
             cave_id = cave['id']
@@ -57,8 +66,11 @@ def rename_files_and_update_json(data: list, base_dir: str):
             # 将时间字符串转换为所需的毫秒时间戳
             timestamp_ms = convert_iso_to_ms_timestamp(time_str)
 
+            # 新文件名中除序号和拓展名外的部分在同一 cave 内不变，预先构建
+            name_head = f"{cave_id}-"
+            name_tail = f"_{channel_id}-{user_id}_{timestamp_ms}"
+
             media_index = 0
-            entry_updated = False
             # 遍历 elements 列表以查找文件
             for element in cave.get('elements', []):
                 # 检查是否为包含文件的媒体元素
@@ -66,42 +78,72 @@ def rename_files_and_update_json(data: list, base_dir: str):
                     media_index += 1  # 同一ID下多个文件的索引
 
                     old_filename = element['file']
-                    _, extension = os.path.splitext(old_filename)
+
+                    # 先对照目录清单检查原始文件是否存在，缺失时无需构建新文件名
+                    if old_filename not in media.existing:
+                        media.log.append(f"  跳过: 原始文件未找到 '{old_filename}'")
+                        total_skipped += 1
+                        continue
+
+                    _, extension = split_ext(old_filename)
 
                     # 根据代码规范构建新的文件名
-                    new_filename = f"{cave_id}-{media_index}_{channel_id}-{user_id}_{timestamp_ms}{extension}"
-
-                    old_path = os.path.join(base_dir, old_filename)
-                    new_path = os.path.join(base_dir, new_filename)
-
-                    # 检查原始文件是否存在
-                    if os.path.exists(old_path):
-                        # 重命名文件
-                        os.rename(old_path, new_path)
-                        print(f"  成功: '{old_filename}' -> '{new_filename}'")
-                        
-                        # !!! 关键步骤: 更新 JSON 数据中对应的文件名
-                        element['file'] = new_filename
-                        entry_updated = True
-                        total_renamed += 1
-                    else:
-                        print(f"  跳过: 原始文件未找到 '{old_filename}'")
+                    new_filename = f"{name_head}{media_index}{name_tail}{extension}"
+
+                    # 检查是否需要或能够重命名
+                    if old_filename == new_filename:
+                        continue
+                    if new_filename in media.existing:
+                        media.log.append(f"  冲突: 目标文件已存在，跳过 '{old_filename}' -> '{new_filename}'")
                         total_skipped += 1
-            
-            if entry_updated:
-                updated_json_entries += 1
+                        continue
+
+                    # 记录待重命名的文件
+                    pending.append((cave, element, old_filename, new_filename))
+                    count += 1
+
+                    # !!! 关键步骤: 预先更新 JSON 数据中对应的文件名
+                    element['file'] = new_filename
 
         except KeyError as e:
-            print(f"  警告: 因缺少键而跳过条目: {e}")
+            media.log.append(f"  警告: 因缺少键而跳过条目: {e}")
         except Exception as e:
-            print(f"  错误: 处理条目 {cave.get('id', 'N/A')} 时发生意外错误: {e}")
+            media.log.append(f"  错误: 处理条目 {cave.get('id', 'N/A')} 时发生意外错误: {e}")
+        return count
+
+    def flush():
+        """批量重命名文件，失败时回滚 JSON 数据中的文件名。"""
+        nonlocal total_renamed, total_skipped, updated_json_entries
+        updated_caves = set()
+        errors = media.rename([(old_filename, new_filename) for _, _, old_filename, new_filename in pending])
+        for (cave, element, old_filename, new_filename), error in zip(pending, errors):
+            if error is None:
+                media.log.append(f"  成功: '{old_filename}' -> '{new_filename}'")
+                updated_caves.add(id(cave))
+                total_renamed += 1
+            elif isinstance(error, FileExistsError):
+                element['file'] = old_filename
+                media.log.append(f"  冲突: 目标文件已存在，跳过 '{old_filename}' -> '{new_filename}'")
+                total_skipped += 1
+            else:
+                element['file'] = old_filename
+                media.log.append(f"  错误: 重命名 '{old_filename}' 时发生意外错误: {error}")
+                total_skipped += 1
+        updated_json_entries += len(updated_caves)
+        pending.clear()
+        media.print_log()
+
+    # 遍历 JSON 数据中的每一条 cave
+    with MediaDir(base_dir) as media:
+        yield from stream_batches(data, collect, flush, max_batch)
 
     print("\n--- 处理完成 ---")
     print(f"成功重命名文件: {total_renamed} 个")
     print(f"成功更新 JSON 条目: {updated_json_entries} 条")
-    print(f"跳过 (文件未找到): {total_skipped} 个")
-    
-    return data
+    print(f"跳过 (文件未找到或无法重命名): {total_skipped} 个")
+
+    if stats is not None:
+        stats.update(renamed=total_renamed, updated=updated_json_entries, skipped=total_skipped)
 
 
 if __name__ == "__main__":
@@ -111,16 +153,17 @@ if __name__ == "__main__":
     elif not os.path.isdir(media_dir):
         print(f"错误: 媒体目录未找到 '{media_dir}'")
     else:
-        # 打开并加载 JSON 数据
-        with open(input_json_path, 'r', encoding='utf-8') as f:
-            cave_data = json.load(f)
-        
-        # 调用主函数执行重命名和更新操作
-        updated_data = rename_files_and_update_json(cave_data, media_dir)
-
-        # 如果成功处理，则将更新后的数据写入新文件
-        if updated_data:
-            with open(output_json_path, 'w', encoding='utf-8') as f:
-                # 使用 indent 参数美化输出，ensure_ascii=False 确保中文等字符正确显示
-                json.dump(updated_data, f, ensure_ascii=False, indent=4)
-            print(f"\n已成功将更新后的数据保存到: '{output_json_path}'")
\ No newline at end of file
+        # 逐条读取 JSON 数据，处理后直接写入临时文件，只有确实重命名了文件时才替换为输出文件
+        stats = {'renamed': 0}
+        try:
+            # 调用主函数执行重命名和更新操作
+            saved = rewrite_caves(input_json_path, output_json_path,
+                                  partial(rename_files_and_update_json, base_dir=media_dir, stats=stats),
+                                  lambda: stats['renamed'] > 0)
+        except JSON_ERRORS as e:
+            print(f"错误: JSON 文件格式无效，无法解析。 {e}")
+        else:
+            if saved:
+                print(f"\n已成功将更新后的数据保存到: '{output_json_path}'")
+            else:
+                print(f"\n没有文件被重命名，无需生成 '{output_json_path}'。")
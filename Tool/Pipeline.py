@@ -0,0 +1,167 @@
+import os
+import random
+from functools import partial
+from typing import Iterable
+
+# 复用两个修复脚本及共用模块中的函数，请将本脚本与 FixExtension.py、FixIndexAndAddTime.py、_fsutil.py 放在同一目录
+from FixExtension import SAFE_EXT, SAMPLE_RATE, probe_file
+from FixIndexAndAddTime import convert_iso_to_ms_timestamp
+from _fsutil import JSON_ERRORS, MediaDir, rewrite_caves, split_ext, stream_batches
+
+# --- 配置 ---
+# 请根据你的实际情况修改这些路径
+# 输入的 JSON 文件路径
+input_json_path = 'cave_export.json'
+# 输出更新后的 JSON 文件路径
+output_json_path = 'cave_export_updated.json'
+# 包含媒体文件的目录路径
+media_dir = 'cave'
+# 是否信任常见的拓展名 (开启后仅抽样检查这些文件，速度更快，但可能漏掉标错的文件)
+trust_common_ext = False
+# --- 配置结束 ---
+
+
+def fix_caves(data: Iterable, base_dir: str, stats: dict, trust_common_ext: bool = False,
+              max_batch: int = 256, max_workers: int = 32):
+    """
+    在一次遍历中完成 FixExtension 与 FixIndexAndAddTime 的工作：
+    识别文件的真实拓展名，并按 ${caveId}-${index}_${channelId}-${userId}_${timestamp}${ext} 重命名，
+    每个文件只重命名一次。以生成器形式逐条产出处理后的 cave，统计结果累加到 stats 中。
+    缺少 id 或 time 的 cave 无法构建新文件名，仍会修正其文件的拓展名。
+    """
+    # 待处理的文件: (cave, element, 原文件名, 不含拓展名的新文件名, 是否需要识别类型)
+    queued = []
+
+    def collect(cave) -> int:
+        """为 cave 中的媒体文件确定不含拓展名的新文件名并登记，返回登记的数量。"""
+        try:
+            # 从 cave 对象中提取元数据，新文件名中除序号和拓展名外的部分在同一 cave 内不变
+            name_head = f"{cave['id']}-"
+            name_tail = (f"_{cave.get('channelId', 'unknown')}-{cave.get('userId', 'unknown')}"
+                         f"_{convert_iso_to_ms_timestamp(cave['time'])}")
+        except KeyError as e:
+            media.log.append(f"  警告: 条目缺少键 {e}，仅修正其文件的拓展名")
+            name_head = None
+        except Exception as e:
+            media.log.append(f"  错误: 处理条目 {cave.get('id', 'N/A')} 时发生意外错误: {e}，仅修正其文件的拓展名")
+            name_head = None
+
+        count = 0
+        media_index = 0
+        for element in cave.get('elements', []):
+            # 检查是否为包含文件的媒体元素
+            if 'file' in element and element.get('type') in ['image', 'video', 'audio', 'file', 'gif']:
+                media_index += 1  # 同一ID下多个文件的索引
+
+                old_filename = element['file']
+                if old_filename not in media.existing:
+                    media.log.append(f"  跳过: 原始文件未找到 '{old_filename}'")
+                    stats['skipped'] += 1
+                    continue
+
+                # 信任模式下，常见拓展名的文件仅抽样识别类型
+                sniff = not (trust_common_ext and random.random() >= SAMPLE_RATE
+                             and split_ext(old_filename)[1].lower() in SAFE_EXT)
+                # 无法构建新文件名时保留原主名，只修正拓展名
+                new_stem = (f"{name_head}{media_index}{name_tail}" if name_head is not None
+                            else split_ext(old_filename)[0])
+                queued.append((cave, element, old_filename, new_stem, sniff))
+                count += 1
+        return count
+
+    def flush():
+        """并发识别文件类型，确定最终文件名后批量重命名，失败时回滚 JSON 中的记录。"""
+        probe = partial(probe_file, dir_fd=media.dir_fd)
+        sniffed = [media.prefix + old_filename for _, _, old_filename, _, sniff in queued if sniff]
+        kinds = iter(media.map(probe, sniffed))
+
+        # 待重命名的文件: (cave, element, 原文件名, 新文件名, 是否修正了拓展名)
+        pending = []
+        for cave, element, old_filename, new_stem, sniff in queued:
+            _, extension = split_ext(old_filename)
+            kind = next(kinds) if sniff else None
+            if isinstance(kind, FileNotFoundError):
+                media.log.append(f"  跳过: 原始文件未找到 '{old_filename}'")
+                stats['skipped'] += 1
+                continue
+            elif isinstance(kind, Exception):
+                media.log.append(f"  错误: 识别 '{old_filename}' 的文件类型时发生意外错误: {kind}")
+            elif kind is None and sniff:
+                media.log.append(f"  提示: 无法识别 '{old_filename}' 的文件类型，保留原拓展名")
+
+            # 识别出的拓展名与当前拓展名不同时使用识别结果
+            ext_fixed = isinstance(kind, str) and extension.lower() != f".{kind}"
+            if ext_fixed:
+                extension = f".{kind}"
+
+            new_filename = f"{new_stem}{extension}"
+            if old_filename == new_filename:
+                continue
+            if new_filename in media.existing:
+                media.log.append(f"  冲突: 目标文件已存在，跳过 '{old_filename}' -> '{new_filename}'")
+                stats['skipped'] += 1
+                continue
+
+            # 记录待重命名的文件，并预先更新 JSON 数据中对应的文件名
+            pending.append((cave, element, old_filename, new_filename, ext_fixed))
+            element['file'] = new_filename
+
+        updated_caves = set()
+        errors = media.rename([(old_filename, new_filename) for _, _, old_filename, new_filename, _ in pending])
+        for (cave, element, old_filename, new_filename, ext_fixed), error in zip(pending, errors):
+            if error is None:
+                media.log.append(f"  成功: '{old_filename}' -> '{new_filename}'")
+                updated_caves.add(id(cave))
+                stats['renamed'] += 1
+                stats['corrected'] += ext_fixed
+            elif isinstance(error, FileExistsError):
+                element['file'] = old_filename
+                media.log.append(f"  冲突: 目标文件已存在，跳过 '{old_filename}' -> '{new_filename}'")
+                stats['skipped'] += 1
+            else:
+                element['file'] = old_filename
+                media.log.append(f"  错误: 重命名 '{old_filename}' 时发生意外错误: {error}")
+                stats['skipped'] += 1
+        stats['updated'] += len(updated_caves)
+        queued.clear()
+        media.print_log()
+
+    with MediaDir(base_dir, max_workers) as media:
+        yield from stream_batches(data, collect, flush, max_batch)
+
+
+def pipeline(in_path: str, out_path: str, base_dir: str, trust_common_ext: bool = False):
+    """
+    读取一次 JSON 数据，同时修正媒体文件的拓展名、序号与时间戳，并写入输出文件。
+    """
+    if not os.path.exists(in_path):
+        print(f"错误: JSON 文件未找到 '{in_path}'")
+        return
+    if not os.path.isdir(base_dir):
+        print(f"错误: 媒体目录未找到 '{base_dir}'")
+        return
+
+    print(f"开始处理目录: '{base_dir}'")
+    stats = {'renamed': 0, 'corrected': 0, 'updated': 0, 'skipped': 0}
+    try:
+        # 只有确实重命名了文件时，才将更新后的数据保存为输出文件
+        saved = rewrite_caves(in_path, out_path,
+                              partial(fix_caves, base_dir=base_dir, stats=stats, trust_common_ext=trust_common_ext),
+                              lambda: stats['renamed'] > 0)
+    except JSON_ERRORS as e:
+        print(f"错误: JSON 文件格式无效，无法解析。 {e}")
+        return
+
+    print("\n--- 处理完成 ---")
+    print(f"成功重命名文件: {stats['renamed']} 个 (其中修正拓展名 {stats['corrected']} 个)")
+    print(f"成功更新 JSON 条目: {stats['updated']} 条")
+    print(f"跳过 (文件未找到或无法重命名): {stats['skipped']} 个")
+
+    if saved:
+        print(f"\n已成功将更新后的数据保存到: '{out_path}'")
+    else:
+        print(f"\n没有文件被重命名，无需生成 '{out_path}'。")
+
+
+if __name__ == "__main__":
+    pipeline(input_json_path, output_json_path, media_dir, trust_common_ext)
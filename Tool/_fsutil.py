@@ -0,0 +1,270 @@
+"""
+迁移脚本共用的文件与 JSON 工具函数，请与使用它的脚本放在同一目录。
+"""
+import ctypes
+import errno
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Iterable
+
+try:
+    import ijson
+    JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    JSON_ERRORS = (json.JSONDecodeError,)
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# JSON 文件读写使用的缓冲区大小，较大的缓冲区可减少读写大文件时的系统调用次数
+BUF = max(io.DEFAULT_BUFFER_SIZE, 262144)
+
+# renameat2(2) 的标志位，目标已存在时失败而不是覆盖
+RENAME_NOREPLACE = 1
+# 表示相对于当前工作目录的目录描述符
+AT_FDCWD = -100
+
+
+def _load_renameat2():
+    """
+    在 Linux 上通过 ctypes 加载 libc 的 renameat2，不可用时返回 None。
+    """
+    if sys.platform != 'linux':
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+_renameat2 = _load_renameat2()
+
+
+def open_dir(path: str):
+    """
+    打开目录并返回其文件描述符，之后可用相对文件名操作目录中的文件，
+    省去每次调用时的路径解析。平台不支持时返回 None。
+    """
+    if os.rename not in os.supports_dir_fd or not hasattr(os, 'O_DIRECTORY'):
+        return None
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def split_ext(filename: str):
+    """
+    拆分不含目录的文件名为 (主名, 拓展名)，用于替代较慢的 os.path.splitext。
+    """
+    dot = filename.rfind('.')
+    if dot <= 0:
+        return filename, ''
+    return filename[:dot], filename[dot:]
+
+
+def _do_rename(old_path: str, new_path: str, dir_fd=None):
+    """
+    重命名单个文件且不覆盖已有文件，成功返回 None，失败返回异常对象 (目标已存在时为 FileExistsError)。
+    Linux 上优先使用 renameat2(RENAME_NOREPLACE)；否则先建立硬链接再删除原文件，
+    文件系统不支持硬链接时退回到检查目标后重命名。
+    """
+    if _renameat2 is not None:
+        # 由内核在同一次系统调用中原子地检查目标并重命名
+        fd = AT_FDCWD if dir_fd is None else dir_fd
+        if _renameat2(fd, os.fsencode(old_path), fd, os.fsencode(new_path), RENAME_NOREPLACE) == 0:
+            return None
+        err = ctypes.get_errno()
+        # 文件系统不支持该标志时退回到下面的方式
+        if err not in (errno.EINVAL, errno.ENOSYS):
+            return OSError(err, os.strerror(err), old_path, None, new_path)
+    try:
+        try:
+            os.link(old_path, new_path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError:
+            try:
+                os.stat(new_path, dir_fd=dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                os.rename(old_path, new_path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+                return None
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), new_path)
+        os.unlink(old_path, dir_fd=dir_fd)
+    except OSError as e:
+        return e
+    return None
+
+
+def batch_rename(pairs: list, executor: ThreadPoolExecutor, dir_fd=None) -> list:
+    """
+    在线程池 executor 中并发重命名文件，返回与 pairs 一一对应的结果 (成功为 None，失败为异常对象)。
+    传入 dir_fd 时，pairs 中的路径均相对于该目录。
+    同一原文件出现多次时只重命名第一次，其余视为原文件不存在。
+    """
+    rename = partial(_do_rename, dir_fd=dir_fd)
+    if len(pairs) < 2:
+        return [rename(old_path, new_path) for old_path, new_path in pairs]
+
+    # 并发执行时，同一原文件的多次硬链接都会成功而只有一次删除成功，会留下多余的文件，因此预先去重
+    results = [None] * len(pairs)
+    seen = set()
+    unique = []
+    for i, (old_path, _) in enumerate(pairs):
+        if old_path in seen:
+            results[i] = FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), old_path)
+        else:
+            seen.add(old_path)
+            unique.append(i)
+    for i, error in zip(unique, executor.map(rename, *zip(*(pairs[i] for i in unique)))):
+        results[i] = error
+    return results
+
+
+def iter_caves(f):
+    """
+    逐条读取 JSON 数组中的 cave。
+    安装了 ijson 时以流式方式解析，无需将整个文件载入内存。
+    """
+    if ijson is not None:
+        yield from ijson.items(f, 'item', use_float=True)
+    else:
+        yield from json.load(f)
+
+
+def write_caves(f, caves: Iterable) -> int:
+    """
+    将 cave 以每行一条的 JSON 数组格式写入二进制文件，返回写入的条数。
+    """
+    count = 0
+    f.write(b'[\n')
+    for cave in caves:
+        if count:
+            f.write(b',\n')
+        f.write(dumps(cave))
+        count += 1
+    f.write(b'\n]\n')
+    return count
+
+
+def validate_json(path: str):
+    """
+    完整解析一遍 JSON 文件，格式无效时抛出 JSON_ERRORS 中的异常。
+    流式解析要读到出错的位置才会报错，而此前的文件可能已被重命名，因此在处理前先检查；
+    未安装 ijson 时 iter_caves 本就会在产出第一条 cave 前解析整个文件，无需重复检查。
+    """
+    if ijson is None:
+        return
+    with open(path, 'rb', buffering=BUF) as f:
+        for _ in ijson.basic_parse(f):
+            pass
+
+
+def rewrite_caves(in_path: str, out_path: str, process, keep) -> bool:
+    """
+    校验输入文件后逐条读取其中的 cave，经 process 处理后写入临时文件；
+    完成后 keep() 为真时用临时文件替换 out_path，否则丢弃临时文件。返回是否写出了 out_path。
+    输入文件格式无效时抛出 JSON_ERRORS 中的异常，此时不会处理任何文件。
+    """
+    validate_json(in_path)
+    tmp_path = out_path + '.tmp'
+    try:
+        with open(in_path, 'rb', buffering=BUF) as f_in, open(tmp_path, 'wb', buffering=BUF) as f_out:
+            write_caves(f_out, process(iter_caves(f_in)))
+        if keep():
+            os.replace(tmp_path, out_path)
+            return True
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class MediaDir:
+    """
+    一次运行中对媒体目录的访问：目录中已有文件名的清单、用于相对路径访问的目录描述符、
+    识别与重命名共用的线程池，以及按批输出的日志。作为上下文管理器使用，退出时关闭目录描述符和线程池。
+    """
+
+    def __init__(self, path: str, max_workers: int = 32):
+        # 一次性读取目录中已有的文件名，避免逐个检查文件是否存在
+        with os.scandir(path) as it:
+            self.existing = {entry.name for entry in it if entry.is_file()}
+        # 支持时以目录描述符加相对文件名访问文件
+        self.dir_fd = open_dir(path)
+        self.prefix = '' if self.dir_fd is not None else path + os.sep
+        # 整个运行期间复用的线程池，避免每批重新创建线程
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # 本批次待输出的日志
+        self.log = []
+
+    def rename(self, pairs: list) -> list:
+        """
+        批量重命名目录中的文件，pairs 为 (原文件名, 新文件名)，返回与之一一对应的结果。
+        重命名成功的文件同步更新到文件清单中。
+        """
+        prefix = self.prefix
+        errors = batch_rename([(prefix + old, prefix + new) for old, new in pairs], self.executor, self.dir_fd)
+        for (old_filename, new_filename), error in zip(pairs, errors):
+            if error is None:
+                self.existing.discard(old_filename)
+                self.existing.add(new_filename)
+        return errors
+
+    def print_log(self):
+        """输出并清空本批次的日志，每批只输出一次，避免逐行写入标准输出。"""
+        if self.log:
+            print('\n'.join(self.log))
+            self.log.clear()
+
+    def map(self, func, items: list) -> list:
+        """在线程池中对 items 逐个调用 func，按顺序返回结果列表。"""
+        return list(self.executor.map(func, items))
+
+    def close(self):
+        self.executor.shutdown()
+        if self.dir_fd is not None:
+            os.close(self.dir_fd)
+            self.dir_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def stream_batches(data: Iterable, collect, flush, max_batch: int = 256):
+    """
+    逐条产出 data 中的 cave。collect(cave) 登记该 cave 中待处理的文件并返回登记的数量，
+    累计达到 max_batch 个时调用 flush() 统一处理，再产出对应的 cave；
+    之前没有待处理的文件时，cave 立即产出，不在内存中停留。
+    """
+    # 已登记文件但尚未产出的 cave
+    buffered = []
+    queued = 0
+    for cave in data:
+        queued += collect(cave)
+        if not queued:
+            yield cave
+            continue
+        buffered.append(cave)
+        if queued >= max_batch:
+            flush()
+            yield from buffered
+            buffered.clear()
+            queued = 0
+
+    flush()
+    yield from buffered